@@ -2,7 +2,7 @@ import utils
 from os import path
 
 import numpy as np
-from scipy import stats, sparse
+from scipy import stats
 from scipy.spatial.distance import pdist, squareform
 
 from sklearn.cluster import AgglomerativeClustering
@@ -36,7 +36,7 @@ for fp in fp_names:
     print('Loading:', fp)
     featureMatrix, labels = utils.load_feature_and_label_matrices(type=fp)
     featureMatrix_, labels__ = utils.get_subset(featureMatrix, y, indices=col_indices)
-    fp_dict[fp]=sparse.csr_matrix(featureMatrix_)
+    fp_dict[fp]=featureMatrix_
     fp_probas[fp] = []
 
 
@@ -99,7 +99,7 @@ for _ in tqdm(range(450)):
             x_train, x_test, y_train, y_test = utils.make_cluster_split(fp_dict[fp], y_, clust, test_clusters=test_clusters)
             #Fit some ML model (can be anything - logreg here):
             clf = LogisticRegression(solver='lbfgs', max_iter=1000)
-            clf.fit(sparse.csr_matrix(x_train), y_train[:,idx])
+            clf.fit(x_train, y_train[:,idx])
             #make probaility predictions for the positive class:
             proba = clf.predict_proba(x_test)[:,1]
             fp_probas[fp].append(proba)
@@ -2,7 +2,7 @@ import utils
 from os import path
 
 import numpy as np
-from scipy import stats, sparse
+from scipy import stats
 from scipy.spatial.distance import pdist, squareform
 
 from paris_cluster import ParisClusterer
@@ -44,7 +44,7 @@ for fp in fp_names:
     print(fp)
     featureMatrix, labels = utils.load_feature_and_label_matrices(type=fp)
     featureMatrix_, labels__ = utils.get_subset(featureMatrix, y, indices=col_indices)
-    fp_dict[fp]=sparse.csr_matrix(featureMatrix_)
+    fp_dict[fp]=featureMatrix_
     fp_ap_before_trim[fp] = []
     fp_ap_after_trim[fp] = []
 
@@ -7,15 +7,23 @@ import matplotlib.pyplot as plt
 
 import pandas as pd
 from tqdm import tqdm
-from scipy import sparse
+from joblib import Parallel, delayed, cpu_count
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
 
 
 
 
-def makeMols(num=None):
+def loadSmiles(num=None):
     smiles = pd.read_csv('./raw_data/allSmiles.csv', header=None)
+    return list(smiles[0].iloc[0:num])
+
+def makeMols(num=None):
     mols = list()
-    for smile in smiles[0].iloc[0:num]:
+    for smile in loadSmiles(num):
         mols.append(Chem.MolFromSmiles(smile))
     return np.array(mols)
 
@@ -35,74 +43,128 @@ acidic = '[$([C,S](=[O,S,P])-[O;H1,-1])]'
 aliphatic_C = '[!$(C=C-*);!$(C#*);$(C-*)]'
 
 
-from collections import OrderedDict
 atomTypes = ['D', 'A', 'E', 'H', 'B', 'P', 'L']
 possible_pairs = [sorted(i)[0]+sorted(i)[1] for i in itertools.combinations_with_replacement(atomTypes, 2)]
+#compile the SMARTS once at import rather than once per molecule:
+COMPILED_PATTERNS = tuple((label, Chem.MolFromSmarts(pphore)) for label, pphore in 
+                          zip(atomTypes, [hbd, hba, pi_e, halogen, basic, acidic, aliphatic_C]))
 
 def setProps(mol):
-    for label, pphore in zip(atomTypes, [hbd, hba, pi_e, halogen, basic, acidic, aliphatic_C]):
-        atoms = [i[0] for i in mol.GetSubstructMatches(Chem.MolFromSmarts(pphore))]
-        for atom in atoms:
-            mol.GetAtomWithIdx(atom).SetProp(label, str(1))
-
-def addBond(point, mol, distance, fp):
-    atom1 = [i for i, value in mol.GetAtomWithIdx(point[0]).GetPropsAsDict().items() 
-             if i in atomTypes]
-    atom2 = [i for i, value in mol.GetAtomWithIdx(point[1]).GetPropsAsDict().items() 
-             if i in atomTypes]
-    for x in atom1:
-        for y in atom2:
-            key = sorted((x,y))[0]+sorted((x,y))[1]
-            fp[key][distance] = fp[key][distance]+1
-
-def make_blank_distributions():
-    mol_fp = OrderedDict()
-    for pair in possible_pairs:
-        arr = np.array([0,0,0,0,0,0,0,0,0,0])
-        mol_fp[pair] = arr
-    return mol_fp
-
-def getDistances(mol, fp_dict):
-    distanceMatrix = Chem.GetDistanceMatrix(mol)
-    for point in itertools.combinations(range(distanceMatrix.shape[0]), 2):
-        distance = distanceMatrix[point[0]][point[1]]
-        if distance<11:
-            addBond(point, mol, int(distance)-1, fp_dict)
-            #addBond_gaussian(point, mol, int(distance)-1, fp_dict)
-    return fp_dict
-
+    for label, patt in COMPILED_PATTERNS:
+        for (idx,) in mol.GetSubstructMatches(patt):
+            mol.GetAtomWithIdx(idx).SetIntProp(label, 1)
+
+#rows of the (7,7) type-pair matrix upper triangle, in the same order as possible_pairs:
+PAIR_ROWS, PAIR_COLS = np.triu_indices(len(atomTypes))
+#PAIR_INDEX[t1,t2] is the position of the (unordered) type pair in possible_pairs:
+PAIR_INDEX = np.empty([len(atomTypes), len(atomTypes)], dtype=np.int8)
+PAIR_INDEX[PAIR_ROWS, PAIR_COLS] = np.arange(len(possible_pairs))
+PAIR_INDEX[PAIR_COLS, PAIR_ROWS] = np.arange(len(possible_pairs))
+
+def getAtomTypes(mol):
+    """Reads the pharmacophore props set by setProps into a (N_atoms, 7)
+    matrix where P[i,t]==1 if atom i has type atomTypes[t]"""
+    P = np.zeros([mol.GetNumAtoms(), len(atomTypes)], dtype=np.int32)
+    for atom in mol.GetAtoms():
+        for t, label in enumerate(atomTypes):
+            if atom.HasProp(label):
+                P[atom.GetIdx(), t] = 1
+    return P
+
+def make_blank_distributions(dtype=np.int32):
+    return np.zeros([len(possible_pairs),10], dtype=dtype)
+
+def getDistanceMatrix(mol):
+    """Topological distances as int8. Atoms in disconnected fragments get 
+    RDKit's 1e8 sentinel, so clip before casting to keep them out of range."""
+    return np.minimum(Chem.GetDistanceMatrix(mol), 127).astype(np.int8)
+
+def getDistances(mol, P):
+    """Counts type pairs at each topological distance 1..10. Each atom is
+    expanded into one (atom, type) entry per type it has, and every pair 
+    of entries from atoms i<j within range gets a combined index 
+    PAIR_INDEX[type_i,type_j]*10 + bin, so one bincount fills the whole
+    fingerprint."""
+    distanceMatrix = getDistanceMatrix(mol)
+    atoms, types = np.nonzero(P)
+    d = distanceMatrix[atoms[:,None], atoms[None,:]]
+    valid = (atoms[:,None] < atoms[None,:]) & (d>=1) & (d<=10)
+    index = PAIR_INDEX[types[:,None], types[None,:]].astype(np.intp)*10 + d - 1
+    counts = np.bincount(index[valid], minlength=len(possible_pairs)*10)
+    return counts.reshape(len(possible_pairs), 10).astype(np.int32)
+
+def _accumulate(P, D, pair_index, out):
+    """Compiled equivalent of getDistances: walks each atom pair once
+    and adds its type pairs into the (28,10) count array `out`."""
+    n = P.shape[0]
+    ntypes = P.shape[1]
+    for i in range(n):
+        for j in range(i+1, n):
+            d = D[i,j]
+            if d<1 or d>10:
+                continue
+            for ti in range(ntypes):
+                if not P[i,ti]:
+                    continue
+                for tj in range(ntypes):
+                    if P[j,tj]:
+                        out[pair_index[ti,tj], d-1] += 1
+
+if HAVE_NUMBA:
+    _accumulate = njit(cache=True)(_accumulate)
+
+
+#GAUSS[d] is the gaussian-smeared contribution of a pair at distance bin d:
+GAUSS = np.exp(-(np.arange(10)[None,:] - np.arange(11)[:,None])**2)
 
 def addBond_gaussian(point, mol, distance, fp):
-    atom1 = [i for i, value in mol.GetAtomWithIdx(point[0]).GetPropsAsDict().items() 
-             if i in atomTypes]
-    atom2 = [i for i, value in mol.GetAtomWithIdx(point[1]).GetPropsAsDict().items() 
-             if i in atomTypes]
+    """fp should be a float array from make_blank_distributions(float)"""
+    atom1 = [t for t, label in enumerate(atomTypes) if mol.GetAtomWithIdx(point[0]).HasProp(label)]
+    atom2 = [t for t, label in enumerate(atomTypes) if mol.GetAtomWithIdx(point[1]).HasProp(label)]
     for x in atom1:
         for y in atom2:
-            key = sorted((x,y))[0]+sorted((x,y))[1]
-            g_dist = np.abs(np.arange(0, 10, 1) - distance)
-            g_dist = np.exp(-g_dist*g_dist)
-            fp[key] = fp[key]+ g_dist
+            fp[PAIR_INDEX[x, y]] += GAUSS[distance]
             
             
 def make_FP(mol):
     setProps(mol)
-    fp_dict = make_blank_distributions()
-    fp_dict = getDistances(mol, fp_dict)
-    blank_FP = np.zeros([28,10])
-    for count, (key, value) in enumerate(fp_dict.items()):
-        blank_FP[count] = value
-    return blank_FP.reshape(1,-1)[0]
+    P = getAtomTypes(mol)
+    if HAVE_NUMBA:
+        fp = make_blank_distributions()
+        _accumulate(P, getDistanceMatrix(mol), PAIR_INDEX, fp)
+    else:
+        fp = getDistances(mol, P)
+    #counts are accumulated as int32 and only cast at the end:
+    return fp.reshape(-1).astype(np.float32)
+
+def _fp_worker(smile):
+    #rebuild the mol inside the worker so RDKit Mols never need pickling
+    return make_FP(Chem.MolFromSmiles(smile))
+
+def make_FPs(smiles, n_jobs=None):
+    """Calculates CATS fingerprints for a list of SMILES in parallel.
+    Each molecule is independent so this scales across cores. n_jobs 
+    defaults to the number of physical cores, since hyperthreads
+    just contend with each other in RDKit."""
+    if n_jobs is None:
+        n_jobs = cpu_count(only_physical_cores=True)
+    fps = np.empty((len(smiles), len(possible_pairs)*10), dtype=np.float32)
+    if n_jobs==1:
+        for count, smile in enumerate(tqdm(smiles)):
+            fps[count] = _fp_worker(smile)
+        return fps
+    #results come back in order as they finish, so tqdm tracks completed work
+    #rather than jobs handed to the workers:
+    results = Parallel(n_jobs=n_jobs, backend='loky', batch_size='auto', return_as='generator')(
+        delayed(_fp_worker)(smile) for smile in smiles)
+    for count, fp in enumerate(tqdm(results, total=len(smiles))):
+        fps[count] = fp
+    return fps
 
 
 if __name__=='__main__':
 
-    mols = makeMols()
-    
-    fps = list()
-    for mol in tqdm(mols):
-        fp = make_FP(mol)
-        fps.append(fp)
-
-    fps = np.array(fps)
-    sparse.save_npz('./processed_data/fingerprints/cats.npz', sparse.csr_matrix(fps))
+    smiles = loadSmiles()
+    fps = make_FPs(smiles)
+    #CATS fingerprints are short and mostly nonzero, so store them dense:
+    np.save('./processed_data/fingerprints/cats.npy', fps)
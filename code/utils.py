@@ -2,6 +2,7 @@ import numpy as np
 from scipy import sparse
 from scipy.spatial.distance import pdist, cdist, squareform
 import copy
+import os
 
 from sklearn.metrics import precision_score, recall_score, roc_auc_score, label_ranking_loss
 from sklearn.metrics import confusion_matrix, average_precision_score, label_ranking_average_precision_score
@@ -23,8 +24,13 @@ def getNames(short=False):
 def load_feature_and_label_matrices(type='morgan'):
     y = sparse.load_npz('./raw_data/y.npz').toarray()
     if type=='cats':
-        x = sparse.load_npz('./processed_data/fingerprints/cats.npz').toarray()
-        x = sparse.csr_matrix(StandardScaler().fit_transform(x))
+        #cats is dense after mean-centering anyway, so keep it as a float32 array.
+        #make_cats.py saves it as .npy, older runs saved a sparse .npz:
+        if os.path.exists('./processed_data/fingerprints/cats.npy'):
+            x = np.load('./processed_data/fingerprints/cats.npy').astype(np.float32, copy=False)
+        else:
+            x = sparse.load_npz('./processed_data/fingerprints/cats.npz').toarray().astype(np.float32)
+        x = StandardScaler(copy=False).fit_transform(x)
     else:
         x = sparse.load_npz('./processed_data/fingerprints/'+type+'.npz')
     return x, y
@@ -72,9 +78,18 @@ def split_clusters(pos_labels, neg_labels, pos_test_fraction, neg_test_fraction,
     
     return test_clusters, train_clusters
 
+def _label_mask(labels, clusters):
+    """Same as np.isin(labels, clusters) for non-negative integer cluster 
+    labels, but uses a boolean lookup table indexed by label."""
+    clusters = np.asarray(clusters, dtype=int)
+    size = max(labels.max(), clusters.max(initial=-1))+1
+    lookup = np.zeros(size, dtype=bool)
+    lookup[clusters] = True
+    return lookup[labels]
+
 def _split_indices(y_, idx, clusterer, test_clusters, train_clusters):
-    alltest = np.isin(clusterer.labels_, test_clusters)
-    alltrain = np.isin(clusterer.labels_, train_clusters)
+    alltest = _label_mask(clusterer.labels_, test_clusters)
+    alltrain = _label_mask(clusterer.labels_, train_clusters)
     allpos = y_[:,idx].astype(bool)
     allneg = ~allpos
     return alltest, alltrain, allpos, allneg
@@ -87,19 +102,35 @@ def get_four_matrices(y_, idx, clusterer, test_clusters, train_clusters):
     inactives_train_indices = (alltrain&allneg).nonzero()[0]
     return actives_test_indices, actives_train_indices, inactives_test_indices, inactives_train_indices
 
+AVE_THRESHOLDS = np.linspace(0, 1.0, 50)
+
+def _cdf_mean(d, thresholds=AVE_THRESHOLDS):
+    """Equivalent to np.mean([np.mean(d < t) for t in thresholds]). 
+    Swapping the order of the two means, each distance contributes the 
+    fraction of thresholds above it, so this is a single pass over d 
+    with no sort and no per-threshold boolean arrays."""
+    thresholds_at_or_below = np.searchsorted(thresholds, d, side='right')
+    return 1 - thresholds_at_or_below.mean() / len(thresholds)
+
+def _row_mins_by_columns(dmat, rows, col_sets, tile=1024):
+    """For each array of column indices in col_sets, the same as 
+    dmat[rows][:,cols].min(1), but rows are gathered a tile at a time so
+    only a tile x dmat.shape[1] copy of dmat is held at once."""
+    mins = [np.empty(len(rows), dtype=dmat.dtype) for _ in col_sets]
+    for start in range(0, len(rows), tile):
+        block = dmat[rows[start:start+tile]]
+        for cols, row_min in zip(col_sets, mins):
+            row_min[start:start+tile] = block[:,cols].min(1)
+    return mins
+
 def calc_AVE_quick(dmat, actives_train, actives_test, inactives_train, inactives_test):
-    inactive_dmat = dmat[inactives_test]
-    iTest_iTrain_D = inactive_dmat[:,inactives_train].min(1)
-    iTest_aTrain_D = inactive_dmat[:,actives_train].min(1)
-    
-    active_dmat = dmat[actives_test]
-    aTest_aTrain_D = active_dmat[:,actives_train].min(1)
-    aTest_iTrain_D = active_dmat[:,inactives_train].min(1)
-
-    aTest_aTrain_S = np.mean( [ np.mean( aTest_aTrain_D < t ) for t in np.linspace( 0, 1.0, 50 ) ] )
-    aTest_iTrain_S = np.mean( [ np.mean( aTest_iTrain_D < t ) for t in np.linspace( 0, 1.0, 50 ) ] )
-    iTest_iTrain_S = np.mean( [ np.mean( iTest_iTrain_D < t ) for t in np.linspace( 0, 1.0, 50 ) ] )
-    iTest_aTrain_S = np.mean( [ np.mean( iTest_aTrain_D < t ) for t in np.linspace( 0, 1.0, 50 ) ] )
+    iTest_iTrain_D, iTest_aTrain_D = _row_mins_by_columns(dmat, inactives_test, [inactives_train, actives_train])
+    aTest_aTrain_D, aTest_iTrain_D = _row_mins_by_columns(dmat, actives_test, [actives_train, inactives_train])
+
+    aTest_aTrain_S = _cdf_mean(aTest_aTrain_D)
+    aTest_iTrain_S = _cdf_mean(aTest_iTrain_D)
+    iTest_iTrain_S = _cdf_mean(iTest_iTrain_D)
+    iTest_aTrain_S = _cdf_mean(iTest_aTrain_D)
     
     ave = aTest_aTrain_S-aTest_iTrain_S+iTest_iTrain_S-iTest_aTrain_S
     return ave
@@ -107,11 +138,15 @@ def calc_AVE_quick(dmat, actives_train, actives_test, inactives_train, inactives
 
 def trim(dmat, train_indices, test_indices, fraction_to_trim):
     num_to_trim = int(len(train_indices)*fraction_to_trim)
-    new_indices = train_indices[dmat[:,train_indices].min(0).argsort()[num_to_trim:]]
+    if num_to_trim>=len(train_indices):
+        return train_indices[:0]
+    #only need the num_to_trim closest, so a partial sort is enough:
+    nearest = dmat[:,train_indices].min(0)
+    new_indices = train_indices[np.argpartition(nearest, num_to_trim)[num_to_trim:]]
     return new_indices
 
 
-def evaluate_split(x, y, idx, pos_train, pos_test, neg_train, neg_test, auroc=False, ap=True, weight=None):
+def evaluate_split(x, y, idx, pos_train, pos_test, neg_train, neg_test, auroc=False, ap=True, weight=None, solver='lbfgs'):
     all_train = np.concatenate([pos_train, neg_train])
     all_test = np.concatenate([pos_test, neg_test])
     x_train = x[all_train]
@@ -119,7 +154,7 @@ def evaluate_split(x, y, idx, pos_train, pos_test, neg_train, neg_test, auroc=Fa
     y_train = y[all_train][:,idx]
     y_test = y[all_test][:,idx]
     
-    clf = LogisticRegression(solver='lbfgs', max_iter=1000, class_weight=weight)
+    clf = LogisticRegression(solver=solver, max_iter=1000, class_weight=weight)
     clf.fit(x_train, y_train)
     probas = clf.predict_proba(x_test)[:,1]
 
@@ -171,13 +206,18 @@ def merge_feature_matrices(matrices):
     """
     x_actives_train, x_actives_test, x_inactives_train, x_inactives_test = matrices
 
-    x_train = np.vstack([x_actives_train, x_inactives_train]) #stack train instances together
-    x_test = np.vstack([x_actives_test, x_inactives_test]) #stack test instance together
+    if sparse.issparse(x_actives_train):
+        #np.vstack would densify sparse fingerprints:
+        x_train = sparse.vstack([x_actives_train, x_inactives_train], format='csr') #stack train instances together
+        x_test = sparse.vstack([x_actives_test, x_inactives_test], format='csr') #stack test instance together
+    else:
+        x_train = np.vstack([x_actives_train, x_inactives_train]) #stack train instances together
+        x_test = np.vstack([x_actives_test, x_inactives_test]) #stack test instance together
     #build 1D label array based on the sizes of the active/inactive train/test 
-    y_train = np.zeros(len(x_train))
-    y_train[:len(x_actives_train)]=1
-    y_test = np.zeros(len(x_test))
-    y_test[:len(x_actives_test)]=1    
+    y_train = np.zeros(x_train.shape[0])
+    y_train[:x_actives_train.shape[0]]=1
+    y_test = np.zeros(x_test.shape[0])
+    y_test[:x_actives_test.shape[0]]=1    
     return x_train, x_test, y_train, y_test
 
 def split_feature_matrices(x_train, x_test, y_train, y_test, idx):
@@ -201,8 +241,8 @@ def split_feature_matrices(x_train, x_test, y_train, y_test, idx):
 
 ##The following performs test/train splitting by single-linkage clustering:
 def get_split_indices(y_, idx, clusterer, test_clusters, train_clusters):
-    alltest = np.isin(clusterer.labels_, test_clusters)
-    alltrain = np.isin(clusterer.labels_, train_clusters)
+    alltest = _label_mask(clusterer.labels_, test_clusters)
+    alltrain = _label_mask(clusterer.labels_, train_clusters)
     allpos = y_[:,idx].astype(bool)
     allneg = ~allpos
     return alltest, alltrain, allpos, allneg
@@ -222,7 +262,7 @@ def make_cluster_split(x_, y_, clust, percentage_holdout=0.2, test_clusters=Fals
         train_test_split function."""
     if isinstance(test_clusters, bool):
         test_clusters = np.random.choice(clust.labels_.max(), int(clust.labels_.max()*percentage_holdout), replace=False)
-    mask = ~np.isin(clust.labels_, test_clusters)
+    mask = ~_label_mask(clust.labels_, test_clusters)
     x_test = x_[~mask]
     x_train = x_[mask]
     y_test = y_[~mask]
@@ -230,40 +270,67 @@ def make_cluster_split(x_, y_, clust, percentage_holdout=0.2, test_clusters=Fals
     return x_train, x_test, y_train, y_test
 
 ##The following is to calculate AVE bias:
-def fast_jaccard(X, Y=None):
-    """credit: https://stackoverflow.com/questions/32805916/compute-jaccard-distances-on-sparse-matrix"""
-    if isinstance(X, np.ndarray):
-        X = sparse.csr_matrix(X)
+def _binary_csr(X):
+    """Returns X as a CSR matrix whose stored entries are all 1. Input that
+    is already 0/1 is returned without copying, so the usual fingerprints
+    skip the bool->int double cast."""
+    X = sparse.csr_matrix(X)
+    if X.dtype == bool or not np.all(X.data == 1):
+        X = X.copy()
+        X.eliminate_zeros()
+        X = sparse.csr_matrix((np.ones(X.nnz, dtype=np.int32), X.indices, X.indptr), shape=X.shape)
+    return X
+
+def _sparse_distances(intersect, x_sum, y_sum, metric):
+    """Distances stored only where the intersect is nonzero, as a CSR matrix
+    with the same sparsity as `intersect`. Every missing entry has a 
+    distance of 1, i.e. no bits in common."""
+    intersect = intersect.tocsr()
+    rows = np.repeat(np.arange(intersect.shape[0]), np.diff(intersect.indptr))
+    cardinality = x_sum[rows] + y_sum[intersect.indices]
+    if metric=='jaccard':
+        similarity = intersect.data / (cardinality - intersect.data)
+    if metric=='dice':
+        similarity = 2*intersect.data / cardinality
+    return sparse.csr_matrix((1 - similarity, intersect.indices, intersect.indptr), shape=intersect.shape)
+
+def fast_jaccard(X, Y=None, sparse_output=False):
+    """credit: https://stackoverflow.com/questions/32805916/compute-jaccard-distances-on-sparse-matrix
+    With sparse_output=True, returns a CSR matrix from `_sparse_distances()`
+    instead of the dense distance matrix."""
+    X = _binary_csr(X)
     if Y is None:
         Y = X
     else:
-        if isinstance(Y, np.ndarray):
-            Y = sparse.csr_matrix(Y)
+        Y = _binary_csr(Y)
     assert X.shape[1] == Y.shape[1]
 
-    X = X.astype(bool).astype(int)
-    Y = Y.astype(bool).astype(int)
     intersect = X.dot(Y.T)
-    x_sum = X.sum(axis=1).A1
-    y_sum = Y.sum(axis=1).A1
-    xx, yy = np.meshgrid(x_sum, y_sum)
-    union = ((xx + yy).T - intersect)
-    return (1 - intersect / union).A
-
-def fast_dice(X, Y=None):
-    if isinstance(X, np.ndarray):
-        X = sparse.csr_matrix(X).astype(bool).astype(int)
+    x_sum = X.getnnz(axis=1)
+    y_sum = Y.getnnz(axis=1)
+    if sparse_output:
+        return _sparse_distances(intersect, x_sum, y_sum, 'jaccard')
+    intersect = intersect.toarray()
+    #broadcasting avoids materializing a meshgrid pair of NxM arrays:
+    union = x_sum[:,None] + y_sum[None,:] - intersect
+    return 1 - intersect / union
+
+def fast_dice(X, Y=None, sparse_output=False):
+    """With sparse_output=True, returns a CSR matrix from `_sparse_distances()`
+    instead of the dense distance matrix."""
+    X = _binary_csr(X)
     if Y is None:
         Y = X
     else:
-        if isinstance(Y, np.ndarray):
-            Y = sparse.csr_matrix(Y).astype(bool).astype(int)
+        Y = _binary_csr(Y)
             
     intersect = X.dot(Y.T)
     #cardinality = X.sum(1).A
-    cardinality_X = X.getnnz(1)[:,None] #slightly faster on large matrices - 13s vs 16s for 12k x 12k
+    cardinality_X = X.getnnz(1) #slightly faster on large matrices - 13s vs 16s for 12k x 12k
     cardinality_Y = Y.getnnz(1) #slightly faster on large matrices - 13s vs 16s for 12k x 12k
-    return (1-(2*intersect) / (cardinality_X+cardinality_Y.T)).A
+    if sparse_output:
+        return _sparse_distances(intersect, cardinality_X, cardinality_Y, 'dice')
+    return 1-(2*intersect.toarray()) / (cardinality_X[:,None]+cardinality_Y[None,:])
 
 def calcDistMat( fp1, fp2, metric='jaccard' ):
     """Calculates the pairwise distance matrix between features
@@ -272,18 +339,46 @@ def calcDistMat( fp1, fp2, metric='jaccard' ):
 
 
 
-def calc_distance_matrices(matrices, metric='dice'):
+def _min_along_rows(X, Y, distFun, tile=1024):
+    """Row-wise minimum of distFun(X, Y), computed over tiles of rows of X 
+    so the full len(X) x len(Y) distance matrix is never held in memory."""
+    out = np.empty(X.shape[0])
+    for start in range(0, X.shape[0], tile):
+        out[start:start+tile] = _row_min(distFun(X[start:start+tile], Y, sparse_output=True))
+    return out
+
+def _sparse_row_min(D):
+    """Row minima of a CSR distance matrix from `_sparse_distances()`,
+    where any missing entry counts as a distance of 1."""
+    out = np.ones(D.shape[0])
+    nonempty = np.diff(D.indptr) > 0
+    if nonempty.any():
+        out[nonempty] = np.minimum(1.0, np.minimum.reduceat(D.data, D.indptr[:-1][nonempty]))
+    return out
+
+def _row_min(D):
+    """Nearest-neighbour distances from a full distance matrix, a sparse 
+    one from `_sparse_distances()`, or the 1D row minima already returned 
+    by `calc_distance_matrices()`"""
+    if sparse.issparse(D):
+        return _sparse_row_min(D.tocsr())
+    return D if D.ndim==1 else D.min(axis=1)
+
+def calc_distance_matrices(matrices, metric='dice', tile=1024):
     """Performs the first step in calculating AVE bias: 
-    calculating distance matrix between each pair of ligand sets. 
+    calculating the distance from each test ligand to its nearest 
+    neighbour in each train set. 
     
     Parameters:
     	matrices (list): set of four feature matrices in the order:
         x_actives_train, x_actives_test, x_inactives_train, x_inactives_test
+        tile (int): number of test ligands per block of the distance
+        calculation. Only the row minima of each block are kept.
 
     Returns:
-    	distances (list): set of four distance matrices. Columns will
-        be equal to the number of test set ligands, rows will be equal to 
-        the number of train set ligands. """
+    	distances (list): set of four 1D arrays of nearest-neighbour 
+        distances, one entry per test set ligand. This is all that 
+        `calc_AVE()` and `calc_VE()` need from the distance matrices. """
 
     x_actives_train, x_actives_test, x_inactives_train, x_inactives_test = matrices
     #original method (slow - do not use):
@@ -320,31 +415,37 @@ def calc_distance_matrices(matrices, metric='dice'):
         _, iTest_iTrain_D = x_inactives_train_index.query(x_inactives_test)
         print('querying actives train with inactives test', x_actives_test.shape[0], x_inactives_train.shape[0])
         _, iTest_aTrain_D = x_actives_train_index.query(x_inactives_test)
+        aTest_aTrain_D, aTest_iTrain_D, iTest_iTrain_D, iTest_aTrain_D = [_row_min(D) for D in 
+            (aTest_aTrain_D, aTest_iTrain_D, iTest_iTrain_D, iTest_aTrain_D)]
 
     else:
         #faster using sparse input data to avoid calculating lots of zeroes:
-        aTest_aTrain_D = distFun(x_actives_test, x_actives_train)
-        aTest_iTrain_D = distFun(x_actives_test, x_inactives_train)
-        iTest_iTrain_D = distFun(x_inactives_test, x_inactives_train)
-        iTest_aTrain_D = distFun(x_inactives_test, x_actives_train)
+        x_actives_train, x_actives_test, x_inactives_train, x_inactives_test = [_binary_csr(x) for x in 
+            (x_actives_train, x_actives_test, x_inactives_train, x_inactives_test)]
+        aTest_aTrain_D = _min_along_rows(x_actives_test, x_actives_train, distFun, tile)
+        aTest_iTrain_D = _min_along_rows(x_actives_test, x_inactives_train, distFun, tile)
+        iTest_iTrain_D = _min_along_rows(x_inactives_test, x_inactives_train, distFun, tile)
+        iTest_aTrain_D = _min_along_rows(x_inactives_test, x_actives_train, distFun, tile)
     return aTest_aTrain_D, aTest_iTrain_D, iTest_iTrain_D, iTest_aTrain_D
     
 def calc_AVE(distances):
     """Calculates the AVE bias. Please see Wallach et.al https://doi.org/10.1021/acs.jcim.7b00403
 
     Parameters:
-	distances (list): list of distances matrices returned by 
-        `calc_distance_matrices()`
+	distances (list): list of nearest-neighbour distances returned by 
+        `calc_distance_matrices()` (full distance matrices also work)
         
     Returns:
     	AVE (float): the AVE bias"""
 
     aTest_aTrain_D, aTest_iTrain_D, iTest_iTrain_D, iTest_aTrain_D = distances
     
-    aTest_aTrain_S = np.mean( [ np.mean( np.any( aTest_aTrain_D < t, axis=1 ) ) for t in np.linspace( 0, 1.0, 50 ) ] )
-    aTest_iTrain_S = np.mean( [ np.mean( np.any( aTest_iTrain_D < t, axis=1 ) ) for t in np.linspace( 0, 1.0, 50 ) ] )
-    iTest_iTrain_S = np.mean( [ np.mean( np.any( iTest_iTrain_D < t, axis=1 ) ) for t in np.linspace( 0, 1.0, 50 ) ] )
-    iTest_aTrain_S = np.mean( [ np.mean( np.any( iTest_aTrain_D < t, axis=1 ) ) for t in np.linspace( 0, 1.0, 50 ) ] )
+    #np.any(D < t, axis=1) is the same as D.min(axis=1) < t, so one pass 
+    #over each distance matrix is enough:
+    aTest_aTrain_S = _cdf_mean(_row_min(aTest_aTrain_D))
+    aTest_iTrain_S = _cdf_mean(_row_min(aTest_iTrain_D))
+    iTest_iTrain_S = _cdf_mean(_row_min(iTest_iTrain_D))
+    iTest_aTrain_S = _cdf_mean(_row_min(iTest_aTrain_D))
     
     AVE = aTest_aTrain_S-aTest_iTrain_S+iTest_iTrain_S-iTest_aTrain_S
     return AVE
@@ -354,15 +455,15 @@ def calc_VE(distances):
     pre-print is available at: https://arxiv.org/abs/2001.03207 
 
     Parameters:
-        distances (list): list of distances matrices returned by
-        `calc_distance_matrices()`
+        distances (list): list of nearest-neighbour distances returned by
+        `calc_distance_matrices()` (full distance matrices also work)
 
     Returns:
         VE: the VE bias"""
     
     aTest_aTrain_D, aTest_iTrain_D, iTest_iTrain_D, iTest_aTrain_D = distances
-    term_one = np.mean(aTest_iTrain_D.min(axis=1) - aTest_aTrain_D.min(axis=1))
-    term_two = np.mean(iTest_aTrain_D.min(axis=1) - iTest_iTrain_D.min(axis=1))
+    term_one = np.mean(_row_min(aTest_iTrain_D) - _row_min(aTest_aTrain_D))
+    term_two = np.mean(_row_min(iTest_aTrain_D) - _row_min(iTest_iTrain_D))
     VE = np.sqrt(term_one**2+term_two**2)
     return VE
 